@@ -1,22 +1,101 @@
-from concurrent.futures import ThreadPoolExecutor
+import asyncio
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache, partial
 import logging
+import multiprocessing
 import os
-from threading import Event, Thread
+import random
+from threading import Event, Lock, Thread
 import inotify.adapters
 import inotify.constants
 from PIL import Image
-from typing import Union
-from sqlalchemy import Engine, create_engine, delete, func, select
-from sqlalchemy.orm import Session
-
+from typing import Iterable, Union
+from sqlalchemy import (
+    Engine,
+    create_engine,
+    delete,
+    func,
+    insert,
+    literal_column,
+    select,
+)
+from sqlalchemy import event as sqlalchemy_event
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import Session, joinedload, sessionmaker
+from sqlalchemy.pool import QueuePool, StaticPool
+
+from api.classes import ResolutionVariant
 from api.constants import Constants
+from api.decorators import wait_lock
 from api.models import Base, CachedImage, ImageMetadata
 from api.utils.filename import FilenameUtils
 from api.utils.general import GeneralUtils
 from api.utils.image import ImageProcessor
 
 from datetime import timedelta
-from time import perf_counter
+from time import monotonic, perf_counter
+
+_ALLOWED_INPUT_FILE_EXTENSIONS = frozenset(Constants.ALLOWED_INPUT_FILE_EXTENSIONS)
+# SQLite only allows a single writer at a time, so writes are serialized here
+# instead of letting concurrent writers run into "database is locked" errors
+_write_lock = Lock()
+_DIMS_DESC = tuple(sorted(Constants.ALLOWED_DIMENSIONS, reverse=True))
+
+
+def _has_allowed_extension(filename: str) -> bool:
+    return os.path.splitext(filename)[1].lower() in _ALLOWED_INPUT_FILE_EXTENSIONS
+
+
+def _is_source_image_filename(filename: str) -> bool:
+    """
+    Cheap check shared by the startup scan and inotify events, dotfiles (e.g. macOS
+    resource forks or rsync's temporary files) should never be converted. Partial
+    downloads like 'photo.jpg.part' are already rejected by their extension.
+    """
+    if filename.startswith("."):
+        return False
+
+    return _has_allowed_extension(filename)
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    # WAL lets readers proceed while a write is in progress
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.close()
+
+
+def _convert_and_save(
+    filename: str, image_dir: str, cache_dir: str
+) -> tuple[str, str, dict]:
+    """
+    Converts a source image into the unified format and writes it to the cache directory.
+    Lives on module level so that it can be pickled and run in a worker process.
+
+    Returns:
+        tuple[str, str, dict]: the image ID, the original filename and the image metadata columns
+    """
+    with Image.open(os.path.join(image_dir, filename)) as image:
+        id, metadata = ImageProcessor.convert_to_unified_format_and_write_to_filesystem(
+            output_path=cache_dir,
+            image=image,
+            variant_dimensions=Constants.ALLOWED_DIMENSIONS,
+        )
+
+    return (
+        id,
+        filename,
+        {
+            "original_width": metadata.original_width,
+            "original_height": metadata.original_height,
+            "media_type": metadata.media_type,
+            "format": metadata.format,
+            "extension": metadata.extension,
+        },
+    )
 
 
 class Cache:
@@ -24,16 +103,27 @@ class Cache:
     _cache_dir: str
     _logger: logging.Logger
 
-    _inotify_thread: Thread
+    _inotify_thread: Thread = None
+    _render_pool: ThreadPoolExecutor
+    _pending_renders: dict[str, asyncio.Future]
+
+    _INOTIFY_TICK_SECONDS = 0.1
+    _INOTIFY_DEBOUNCE_SECONDS = 0.25
 
     __engine: Engine = None
-    __session = None
+    __session_factory: sessionmaker[Session] = None
 
     __enable_inotify: bool
     __max_initial_cache_generator_workers: int
 
     _stop_event: Event
 
+    _metadata_cache: dict[str, ImageMetadata]
+    _variant_ladders: dict[str, tuple[ResolutionVariant, ...]]
+    _known_files: set[str]
+    _max_rowid: int
+    _total_image_count: int
+
     def __init__(
         self,
         *,
@@ -42,6 +132,7 @@ class Cache:
         enable_inotify: bool = True,
         max_initial_cache_generator_workers: int = 4,
         connection_string: str = "sqlite:///",
+        decoded_source_cache_size: int = 16,
     ):
         image_dir = os.path.abspath(image_dir)
         cache_dir = os.path.abspath(cache_dir)
@@ -53,6 +144,13 @@ class Cache:
         self._cache_dir = cache_dir
         self._image_dir = image_dir
 
+        # a page load usually requests several sizes of the same image, so keep the
+        # last few decoded sources around (roughly 12 MiB each at the maximum size)
+        self._load_source = lru_cache(maxsize=decoded_source_cache_size)(
+            ImageProcessor.load_source
+        )
+        self._share_decoded_sources = decoded_source_cache_size > 0
+
         if not os.path.exists(self._cache_dir):
             self._logger.info(
                 f"Cache directory at '{self._cache_dir}' doesn't exist yet, creating it"
@@ -66,60 +164,83 @@ class Cache:
         # only echo SQL statements if we're logging at the debug level
         echo = self._logger.getEffectiveLevel() <= logging.DEBUG
 
+        if make_url(connection_string).database in (None, "", ":memory:"):
+            # every new connection would open its own empty in-memory database,
+            # so all sessions have to share a single connection
+            pool_args = {"poolclass": StaticPool}
+        else:
+            pool_args = {"poolclass": QueuePool, "pool_size": 8, "max_overflow": 4}
+
         self.__engine = create_engine(
-            connection_string, echo=echo, connect_args={"check_same_thread": False}
+            connection_string,
+            echo=echo,
+            connect_args={"check_same_thread": False},
+            **pool_args,
         )
+        sqlalchemy_event.listen(self.__engine, "connect", _set_sqlite_pragmas)
         Base.metadata.create_all(self.__engine)
-        self.__session = Session(self.__engine)
+        self.__session_factory = sessionmaker(self.__engine)
 
         assert self.__engine is not None
-        assert self.__session is not None
+        assert self.__session_factory is not None
 
         self.__enable_inotify = enable_inotify
         self.__max_initial_cache_generator_workers = max_initial_cache_generator_workers
         self._stop_event = Event()
+        # rendering missing variants is CPU bound, keep it off the event loop
+        self._render_pool = ThreadPoolExecutor(
+            max_workers=os.cpu_count(), thread_name_prefix="render"
+        )
+        # only accessed from the event loop, maps expected filenames to their render
+        self._pending_renders = {}
+        # metadata never changes for a given ID, so it only needs invalidating on deletion
+        self._metadata_cache = {}
+        self._variant_ladders = {}
+        # this process is the only one writing to the cache directory, so after
+        # listing it once we can keep track of its contents ourselves
+        self._known_files = {
+            os.path.join(self._cache_dir, filename)
+            for filename in os.listdir(self._cache_dir)
+        }
+        self._refresh_table_stats()
 
     async def start(self):
-        self._generate_cache(
-            max_threadpool_workers=self.__max_initial_cache_generator_workers
+        await self._generate_cache(
+            max_workers=self.__max_initial_cache_generator_workers
         )
+        self._load_metadata_cache()
+        for id in list(self._metadata_cache):
+            self.get_variant_ladder(id)
 
         if self.__enable_inotify:
             self._dispatch_inotify_thread()
 
-    def _generate_cache(self, max_threadpool_workers: int):
+    async def _generate_cache(self, max_workers: int):
         start = perf_counter()
         generated = 0
         image_files_present_in_directory = []
-
-        def convert_and_save(filename: str):
-            self._logger.debug(f"Started conversion job for '{filename}'")
-            try:
-                with Image.open(os.path.join(self._image_dir, filename)) as image:
-                    id, metadata = (
-                        ImageProcessor.convert_to_unified_format_and_write_to_filesystem(
-                            output_path=self._cache_dir, image=image
-                        )
-                    )
-                    cached_image = CachedImage(
-                        id=id, original_filename=filename, image_metadata=metadata
-                    )
-                    self.__session.add(cached_image)
-                    self._logger.debug(f"Done converting '{filename}'")
-            except OSError:
-                self._logger.exception(f"Failed converting '{filename}'")
-
-        with ThreadPoolExecutor(max_workers=max_threadpool_workers) as executor:
+        new_filenames = []
+        cached_image_rows = []
+        image_metadata_rows = []
+        loop = asyncio.get_running_loop()
+
+        # forked workers inherit the parent's threads in whatever state they're in (e.g.
+        # blake3's hashing pool) and can deadlock, so start them from a clean process
+        with ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context("forkserver"),
+        ) as executor:
             self._logger.info(
-                f"Created initial generation threadpool with {executor._max_workers} workers"
+                f"Created initial generation process pool with {executor._max_workers} workers"
             )
-            for filename in os.listdir(self._image_dir):
-                if (
-                    os.path.splitext(filename.lower())[1]
-                    not in Constants.ALLOWED_INPUT_FILE_EXTENSIONS
-                ):
+            with os.scandir(self._image_dir) as entries:
+                image_entries = [entry for entry in entries if entry.is_file()]
+
+            for entry in image_entries:
+                filename = entry.name
+                if not _is_source_image_filename(filename):
                     self._logger.warning(
-                        f"Ignoring file '{filename}' because it doesn't have an allowed file extension"
+                        f"Ignoring file '{filename}' because it's not a source image"
                     )
                     continue
 
@@ -132,11 +253,53 @@ class Cache:
                     continue
 
                 self._logger.info(f"Caching new file '{filename}'")
-                executor.submit(convert_and_save, filename=filename)
+                new_filenames.append(filename)
+
+            # removed before inserting, metadata left behind for a deleted image would
+            # collide with the new rows if that image was added again
+            num_deleted = self.remove_diff_cached_images(
+                image_files_present_in_directory
+            )
+
+            # the event loop stays responsive while the workers convert the images,
+            # all results are collected here and inserted in bulk afterwards
+            results = await asyncio.gather(
+                *(
+                    loop.run_in_executor(
+                        executor,
+                        _convert_and_save,
+                        filename,
+                        self._image_dir,
+                        self._cache_dir,
+                    )
+                    for filename in new_filenames
+                ),
+                return_exceptions=True,
+            )
+
+            for filename, result in zip(new_filenames, results):
+                # a single broken file must not keep the rest of the images out of the cache,
+                # only cancellation and interrupts abort the scan
+                if isinstance(result, Exception):
+                    self._logger.error(
+                        f"Failed converting '{filename}'", exc_info=result
+                    )
+                    continue
+                elif isinstance(result, BaseException):
+                    raise result
+
+                id, original_filename, metadata = result
+
+                cached_image_rows.append(
+                    {"id": id, "original_filename": original_filename}
+                )
+                image_metadata_rows.append({"id": id, **metadata})
+                self._add_known_files(id, metadata)
+                self._logger.debug(f"Done converting '{filename}'")
                 generated += 1
 
-        self._commit_and_flush()
-        num_deleted = self.remove_diff_cached_images(image_files_present_in_directory)
+        if cached_image_rows:
+            self._insert_images(cached_image_rows, image_metadata_rows)
 
         end = perf_counter()
         self._logger.info(
@@ -153,11 +316,15 @@ class Cache:
         self._stop_event.set()
         if self._inotify_thread and self._inotify_thread.is_alive():
             self._inotify_thread.join(timeout=5)
+        self._render_pool.shutdown(wait=False, cancel_futures=True)
 
     def _watch_fs_events(self):
         logger = logging.getLogger(f"{__name__}.inotify-thread")
+        # editors and mv often emit several events for a single file, so new files are
+        # only converted once no further event arrived for them within the debounce delay
+        pending_files: dict[str, float] = {}
         try:
-            i = inotify.adapters.Inotify()
+            i = inotify.adapters.Inotify(block_duration_s=self._INOTIFY_TICK_SECONDS)
 
             i.add_watch(
                 self._image_dir,
@@ -168,13 +335,24 @@ class Cache:
             )
             logger.info(f"Added watch for folder '{self._image_dir}'")
 
-            for event in i.event_gen(yield_nones=False, timeout_s=1):
+            for event in i.event_gen(yield_nones=True):
                 if self._stop_event.is_set():
                     break
+
+                if event is None:
+                    self._process_pending_files(pending_files, logger)
+                    continue
+
                 (event_obj, _, _, filename) = event
                 logger.debug(event)
                 mask = event_obj.mask
 
+                if not _is_source_image_filename(filename):
+                    logger.debug(
+                        f"Ignoring event for file '{filename}' because it's not a source image"
+                    )
+                    continue
+
                 if (
                     mask & inotify.constants.IN_CLOSE_WRITE
                 ) == inotify.constants.IN_CLOSE_WRITE or (
@@ -183,40 +361,9 @@ class Cache:
                     logger.info(
                         f"Detected new file '{filename}' ({inotify.constants.MASK_LOOKUP[mask]}), adjusting cache"
                     )
-
-                    if (
-                        os.path.splitext(filename.lower())[1]
-                        not in Constants.ALLOWED_INPUT_FILE_EXTENSIONS
-                    ):
-                        logger.warning(
-                            f"Ignoring file '{filename}' because it doesn't have an allowed file extension"
-                        )
-                        continue
-
-                    image: Image.Image = None
-                    try:
-                        image = Image.open(os.path.join(self._image_dir, filename))
-                    except OSError:
-                        logger.exception("Exception while opening file")
-                        continue
-
-                    try:
-                        id, metadata = (
-                            ImageProcessor.convert_to_unified_format_and_write_to_filesystem(
-                                output_path=self._cache_dir, image=image
-                            )
-                        )
-                        cached_image = CachedImage(
-                            id=id, original_filename=filename, image_metadata=metadata
-                        )
-                        self.__session.add(cached_image)
-                        self._commit_and_flush()
-                    except OSError:
-                        logger.exception("Exception while converting file")
-                        continue
-                    finally:
-                        if image:
-                            image.close()
+                    pending_files[filename] = (
+                        monotonic() + self._INOTIFY_DEBOUNCE_SECONDS
+                    )
 
                 elif (
                     mask & inotify.constants.IN_DELETE
@@ -226,11 +373,47 @@ class Cache:
                     logger.info(
                         f"Detected deleted file '{filename}' ({inotify.constants.MASK_LOOKUP[mask]}), adjusting cache"
                     )
+                    pending_files.pop(filename, None)
                     self._delete_by_original_filename(filename)
 
+                self._process_pending_files(pending_files, logger)
+
         except KeyboardInterrupt or InterruptedError as e:
             logger.info(f"{type(e).__name__} received. Stopping thread.")
 
+    def _process_pending_files(
+        self, pending_files: dict[str, float], logger: logging.Logger
+    ):
+        if not pending_files:
+            return
+
+        now = monotonic()
+        due_filenames = [
+            filename for filename, deadline in pending_files.items() if deadline <= now
+        ]
+
+        for filename in due_filenames:
+            del pending_files[filename]
+            try:
+                id, original_filename, metadata = _convert_and_save(
+                    filename, self._image_dir, self._cache_dir
+                )
+                cached_image = CachedImage(
+                    id=id,
+                    original_filename=original_filename,
+                    image_metadata=ImageMetadata(**metadata),
+                )
+                # an existing file may have been overwritten in place
+                self._delete_by_original_filename(original_filename)
+                self._add_image(cached_image)
+                self._metadata_cache.pop(id, None)
+                self._variant_ladders.pop(id, None)
+                self._add_known_files(id, metadata)
+                self._refresh_table_stats()
+            except Exception:
+                # same as the startup scan, one broken file must not stop the watcher
+                logger.exception(f"Failed converting '{filename}'")
+
     def get_filename(
         self,
         id: str,
@@ -258,64 +441,291 @@ class Cache:
                 GeneralUtils.clamp(height, 0, metadata.original_height),
             )
 
-        expected_filename = os.path.join(
-            self._cache_dir,
-            FilenameUtils.get_filename(
-                id=id, width=width, height=height, extension=metadata.extension
-            ),
+        expected_filename = self._get_cache_filename(
+            id, width=width, height=height, extension=metadata.extension
         )
 
         if only_get_filename:
             return expected_filename
 
-        if os.path.isfile(expected_filename):
+        if expected_filename in self._known_files:
             self._logger.info(
                 f"CACHE HIT id='{id}' ({width}x{height}) cache_file='{expected_filename}'"
             )
             return expected_filename
 
-        source_filename = os.path.join(
-            self._cache_dir,
-            FilenameUtils.get_filename(
-                id=id,
-                width=metadata.original_width,
-                height=metadata.original_height,
-                extension=metadata.extension,
-            ),
-        )
-        filename = ImageProcessor.write_scaled_copy_from_source_filename_to_filesystem(
-            id=id,
-            source_filename=source_filename,
-            output_path=self._cache_dir,
-            width=width,
-            height=height,
-            crop_square=square,
+        source_filename = self._get_cache_filename(
+            id,
+            width=metadata.original_width,
+            height=metadata.original_height,
+            extension=metadata.extension,
         )
+        if self._share_decoded_sources:
+            filename = ImageProcessor.write_scaled_copy_to_filesystem(
+                id=id,
+                source=self._load_source(source_filename),
+                output_path=self._cache_dir,
+                width=width,
+                height=height,
+                crop_square=square,
+            )
+        else:
+            # nothing to share between variants, so let the decoder downscale while decoding
+            filename = (
+                ImageProcessor.write_scaled_copy_from_source_filename_to_filesystem(
+                    id=id,
+                    source_filename=source_filename,
+                    output_path=self._cache_dir,
+                    width=width,
+                    height=height,
+                    crop_square=square,
+                )
+            )
+        self._known_files.add(filename)
         self._logger.info(
             f"CACHE MISS id='{id}' ({width}x{height}) cache_file='{filename}'"
         )
 
         return filename
 
+    async def aget_filename(
+        self,
+        id: str,
+        width: Union[int, None] = None,
+        height: Union[int, None] = None,
+        square: bool = False,
+    ) -> str:
+        """
+        Same as get_filename, but renders missing variants on the render pool
+        instead of blocking the event loop
+        """
+        expected_filename = self.get_filename(
+            id, width=width, height=height, square=square, only_get_filename=True
+        )
+        if expected_filename in self._known_files:
+            self._logger.info(
+                f"CACHE HIT id='{id}' ({width}x{height}) cache_file='{expected_filename}'"
+            )
+            return expected_filename
+
+        # concurrent requests for the same missing variant share one render, otherwise
+        # they'd all write to the same file and could serve it half rewritten
+        render = self._pending_renders.get(expected_filename)
+        if render is None:
+            render = asyncio.get_running_loop().run_in_executor(
+                self._render_pool,
+                partial(
+                    self.get_filename, id, width=width, height=height, square=square
+                ),
+            )
+            self._pending_renders[expected_filename] = render
+            render.add_done_callback(
+                lambda _: self._pending_renders.pop(expected_filename, None)
+            )
+
+        # a cancelled request must not cancel the render for everyone else waiting on it
+        return await asyncio.shield(render)
+
+    def get_variant_ladder(self, id: str) -> tuple[ResolutionVariant, ...]:
+        """
+        Returns the downloadable resolution variants of an image, from the largest to the smallest.
+        The variants are shared between callers and always have current set to False.
+        """
+        ladder = self._variant_ladders.get(id)
+        if ladder is not None:
+            return ladder
+
+        metadata = self.get_metadata(id=id)
+        if not metadata:
+            raise ValueError(f"Can't find image by id '{id}'!")
+
+        variants = []
+        for width in _DIMS_DESC:
+            width, height = ImageProcessor.calculate_scaled_size(
+                metadata.original_width,
+                metadata.original_height,
+                width=width,
+            )
+            filename = self.get_filename(
+                id=id,
+                width=width,
+                height=height,
+                square=False,
+                only_get_filename=True,
+            )
+            variants.append(
+                ResolutionVariant(
+                    width=width,
+                    height=height,
+                    current=False,
+                    filename=os.path.basename(filename),
+                )
+            )
+
+        ladder = tuple(variants)
+        self._variant_ladders[id] = ladder
+        return ladder
+
+    def _add_known_files(self, id: str, metadata: dict):
+        """
+        Registers the files written by _convert_and_save for an image
+        """
+        width = metadata["original_width"]
+        height = metadata["original_height"]
+        extension = metadata["extension"]
+
+        self._known_files.add(
+            self._get_cache_filename(
+                id, width=width, height=height, extension=extension
+            )
+        )
+        for variant_width, variant_height, _ in ImageProcessor.get_variant_sizes(
+            width, height, Constants.ALLOWED_DIMENSIONS
+        ):
+            self._known_files.add(
+                self._get_cache_filename(
+                    id,
+                    width=variant_width,
+                    height=variant_height,
+                    extension=extension,
+                )
+            )
+
+    def _get_cache_filename(
+        self, id: str, *, width: int, height: int, extension: str
+    ) -> str:
+        return os.path.join(
+            self._cache_dir,
+            FilenameUtils.get_filename(
+                id=id, width=width, height=height, extension=extension
+            ),
+        )
+
     def get_random_id(self) -> str:
-        select_statement = select(CachedImage.id).order_by(func.random()).limit(1)
-        return self.__session.scalars(select_statement).one_or_none()
+        # ORDER BY random() would have to sort the whole table, while picking the first
+        # row at or after a random rowid is a single B-tree lookup. Gaps left by deleted
+        # rows make the choice slightly uneven, which is fine for a random image.
+        if not self._max_rowid:
+            return None
+
+        rowid = literal_column("rowid")
+        select_statement = (
+            select(CachedImage.id)
+            .where(rowid >= random.randint(1, self._max_rowid))
+            .order_by(rowid)
+            .limit(1)
+        )
+        with self.__session_factory() as session:
+            id = session.scalars(select_statement).one_or_none()
+            if id is None:
+                # the rows at the end of the table have been deleted in the meantime
+                id = session.scalars(select(CachedImage.id).limit(1)).one_or_none()
+
+            return id
+
+    def _refresh_table_stats(self):
+        """
+        Updates the values derived from the image table, has to be called after every write
+        """
+        select_statement = select(
+            func.max(literal_column("rowid")), func.count()
+        ).select_from(CachedImage)
+        with self.__session_factory() as session:
+            max_rowid, total_image_count = session.execute(select_statement).one()
+
+        self._max_rowid = max_rowid or 0
+        self._total_image_count = total_image_count
+
+    def _load_metadata_cache(self):
+        """
+        Loads the metadata of all images in one query, so that requests don't have
+        to go to the database for the first lookup of each ID
+        """
+        with self.__session_factory() as session:
+            self._metadata_cache.update(
+                (metadata.id, metadata)
+                for metadata in session.scalars(
+                    select(ImageMetadata).join(ImageMetadata.image)
+                )
+            )
 
     def get_metadata(self, id: str) -> Union[ImageMetadata, None]:
+        metadata = self._metadata_cache.get(id)
+        if metadata is not None:
+            return metadata
+
         select_statement = select(ImageMetadata).where(ImageMetadata.id.is_(id))
-        return self.__session.scalars(select_statement).one_or_none()
+        with self.__session_factory() as session:
+            metadata = session.scalars(select_statement).one_or_none()
+
+        if metadata is not None:
+            self._metadata_cache[id] = metadata
+
+        return metadata
+
+    async def aget_metadata(self, id: str) -> Union[ImageMetadata, None]:
+        """
+        Same as get_metadata, but looks up uncached metadata in a worker thread
+        instead of blocking the event loop
+        """
+        metadata = self._metadata_cache.get(id)
+        if metadata is not None:
+            return metadata
+
+        return await asyncio.to_thread(self.get_metadata, id)
+
+    def get_metadata_batch(self, ids: Iterable[str]) -> dict[str, ImageMetadata]:
+        """
+        Same as get_metadata for several IDs, looking up all uncached ones in a single query
+        """
+        metadata_by_id = {}
+        missing_ids = []
+        for id in ids:
+            metadata = self._metadata_cache.get(id)
+            if metadata is None:
+                missing_ids.append(id)
+            else:
+                metadata_by_id[id] = metadata
+
+        if missing_ids:
+            select_statement = select(ImageMetadata).where(
+                ImageMetadata.id.in_(missing_ids)
+            )
+            with self.__session_factory() as session:
+                for metadata in session.scalars(select_statement):
+                    self._metadata_cache[metadata.id] = metadata
+                    metadata_by_id[metadata.id] = metadata
+
+        return metadata_by_id
+
+    async def aget_metadata_batch(self, ids: Iterable[str]) -> dict[str, ImageMetadata]:
+        """
+        Same as get_metadata_batch, but only looks up uncached metadata in a worker
+        thread instead of blocking the event loop
+        """
+        ids = list(ids)
+        if all(id in self._metadata_cache for id in ids):
+            return {id: self._metadata_cache[id] for id in ids}
+
+        return await asyncio.to_thread(self.get_metadata_batch, ids)
 
     def id_exists(self, id: str) -> bool:
+        if id in self._metadata_cache:
+            return True
+
         select_statement = select(CachedImage.id).where(CachedImage.id.is_(id))
-        return self.__session.scalars(select_statement).one_or_none() is not None
+        with self.__session_factory() as session:
+            return session.scalars(select_statement).one_or_none() is not None
 
     def get_first_id(self) -> str:
         select_statement = select(CachedImage.id).order_by(CachedImage.id).limit(1)
-        return self.__session.scalars(select_statement).one_or_none()
+        with self.__session_factory() as session:
+            return session.scalars(select_statement).one_or_none()
 
     def get_all_ids(self) -> list[str]:
         select_statement = select(CachedImage.id)
-        return self.__session.scalars(select_statement).all()
+        with self.__session_factory() as session:
+            return session.scalars(select_statement).all()
 
     def get_ids_paged(self, page: int = 0, page_size: int = 50) -> list[str]:
         return self.get_ids_paged_with_offset(
@@ -331,24 +741,51 @@ class Cache:
             .offset(offset)
             .limit(page_size)
         )
-        return self.__session.scalars(select_statement).all()
+        with self.__session_factory() as session:
+            return session.scalars(select_statement).all()
 
     def get_all_images(self) -> list[CachedImage]:
-        select_statement = select(CachedImage)
-        return self.__session.scalars(select_statement).all()
+        # load the metadata in the same query, the session is closed before callers use it
+        select_statement = select(CachedImage).options(
+            joinedload(CachedImage.image_metadata)
+        )
+        with self.__session_factory() as session:
+            return session.scalars(select_statement).all()
 
     def exists_by_original_filename(self, original_filename: str) -> bool:
         select_statement = select(CachedImage).where(
             CachedImage.original_filename.is_(original_filename)
         )
-        return self.__session.scalars(select_statement).one_or_none() is not None
+        with self.__session_factory() as session:
+            return session.scalars(select_statement).one_or_none() is not None
 
     def _get_by_original_filename(self, original_filename: str) -> CachedImage:
-        select_statement = select(CachedImage).where(
-            CachedImage.original_filename.is_(original_filename)
+        select_statement = (
+            select(CachedImage)
+            .options(joinedload(CachedImage.image_metadata))
+            .where(CachedImage.original_filename.is_(original_filename))
         )
-        return self.__session.scalars(select_statement).first()
+        with self.__session_factory() as session:
+            return session.scalars(select_statement).first()
+
+    @wait_lock(_write_lock)
+    def _insert_images(
+        self, cached_image_rows: list[dict], image_metadata_rows: list[dict]
+    ):
+        with self.__session_factory() as session:
+            session.execute(insert(CachedImage), cached_image_rows)
+            session.execute(insert(ImageMetadata), image_metadata_rows)
+            self._commit(session)
+
+        self._refresh_table_stats()
+
+    @wait_lock(_write_lock)
+    def _add_image(self, cached_image: CachedImage):
+        with self.__session_factory() as session:
+            session.add(cached_image)
+            self._commit(session)
 
+    @wait_lock(_write_lock)
     def remove_diff_cached_images(self, original_filenames: list[str]):
         """
         Removes all cached images from the DB that are not in the given list
@@ -356,22 +793,49 @@ class Cache:
         delete_statement = delete(CachedImage).where(
             CachedImage.original_filename.not_in(original_filenames)
         )
-        result = self.__session.execute(delete_statement)
-        self._commit_and_flush()
+        # bulk deletes skip the ORM's delete-orphan cascade and SQLite doesn't enforce
+        # foreign keys, so the metadata has to be removed explicitly
+        delete_orphaned_metadata_statement = delete(ImageMetadata).where(
+            ImageMetadata.id.not_in(select(CachedImage.id))
+        )
+        with self.__session_factory() as session:
+            result = session.execute(delete_statement)
+            orphaned_metadata_result = session.execute(
+                delete_orphaned_metadata_statement
+            )
+            self._commit(session)
+
+        if result.rowcount or orphaned_metadata_result.rowcount:
+            self._metadata_cache.clear()
+            self._variant_ladders.clear()
+            self._load_source.cache_clear()
+
+        self._refresh_table_stats()
         return result.rowcount
 
+    @wait_lock(_write_lock)
     def _delete_by_original_filename(self, original_filename: str):
         select_statement = select(CachedImage).where(
             CachedImage.original_filename.is_(original_filename)
         )
-        result = self.__session.scalars(select_statement).one_or_none()
-        self.__session.delete(result)
-        self._commit_and_flush()
+        with self.__session_factory() as session:
+            result = session.scalars(select_statement).one_or_none()
+            if result is None:
+                return
+
+            id = result.id
+            session.delete(result)
+            self._commit(session)
+
+        self._metadata_cache.pop(id, None)
+        self._variant_ladders.pop(id, None)
+        self._load_source.cache_clear()
+        self._refresh_table_stats()
 
-    def _commit_and_flush(self):
-        self.__session.commit()
-        self.__session.flush()
+    @staticmethod
+    def _commit(session: Session):
+        # commit() already flushes pending changes
+        session.commit()
 
     def get_total_image_count(self) -> int:
-        select_statement = select(func.count()).select_from(CachedImage)
-        return self.__session.execute(select_statement).scalar() or 0
+        return self._total_image_count
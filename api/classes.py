@@ -1,7 +1,24 @@
 from dataclasses import dataclass
-from fastapi.responses import Response
+from fastapi.responses import FileResponse, Response
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
+from typing import Union
+
+
+@dataclass(frozen=True, slots=True)
+class Config:
+    version: str
+    source_image_dir: str
+    cache_dir: str
+    cache_db_file: str
+    submissions_dir: str
+    max_submissions_usage: float
+    site_title: str
+    site_emoji: str
+    default_card_image_id: Union[str, None]
+    max_initial_cache_generator_workers: int
+    decoded_source_cache_size: int
+    loglevel: Union[str, int]
 
 
 @dataclass
@@ -23,6 +40,12 @@ class FaviconResponse(Response):
     media_type = "image/svg+xml"
 
 
+class ImageFileResponse(FileResponse):
+    # cached images are at most a few MiB, so they're usually read from disk in a
+    # single worker thread round trip instead of one per 64 KiB chunk
+    chunk_size = 1024 * 1024
+
+
 class HealthCheckResponse(BaseModel):
     status: str = "healthy"
 
@@ -8,9 +8,10 @@ def wait_lock(lock: Lock):
         @wraps(func)
         def wrapper(*args, **kwargs):
             ThreadingUtils.wait_and_acquire_lock(lock)
-            return_value = func(*args, **kwargs)
-            lock.release()
-            return return_value
+            try:
+                return func(*args, **kwargs)
+            finally:
+                lock.release()
 
         return wrapper
 
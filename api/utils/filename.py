@@ -1,3 +1,4 @@
+from functools import lru_cache
 from PIL import Image
 
 
@@ -12,6 +13,9 @@ class FilenameUtils:
         )
 
     @staticmethod
+    # filenames are a pure function of their arguments and the same handful of
+    # id/size combinations gets requested over and over again
+    @lru_cache(maxsize=4096)
     def get_filename(
         *, id: str, width: int, height: int, extension: str, prefix: str = None
     ):
@@ -1,9 +1,9 @@
 import base64
-import hashlib
 import logging
 import os
-from typing import Union
-from PIL import Image, ImageOps
+from typing import Iterable, Union
+from blake3 import blake3
+from PIL import ExifTags, Image, ImageOps
 
 from api.models import ImageMetadata
 from api.constants import Constants
@@ -12,7 +12,23 @@ from api.utils.filename import FilenameUtils
 MAX_SIZE = Constants.get_max_width()
 FORMAT = Constants.DEFAULT_FORMAT
 EXTENSION = Constants.DEFAULT_EXTENSION
-SAVE_PROPERTIES = {"quality": 95}
+# 4:2:0 chroma subsampling and no extra optimization passes keep encoding cheap
+SAVE_PROPERTIES = {
+    "quality": 85,
+    "subsampling": 2,
+    "optimize": False,
+    "progressive": False,
+}
+# artifacts are hardly visible in small thumbnails
+THUMBNAIL_MAX_SIZE = 256
+THUMBNAIL_SAVE_PROPERTIES = {**SAVE_PROPERTIES, "quality": 80}
+
+# Image.MIME only gets populated once the format plugins are loaded
+Image.preinit()
+MEDIA_TYPE = Image.MIME.get(FORMAT.upper())
+# shrink by an integer factor first (fast box reduction, like libjpeg/libvips
+# shrink-on-load), then resample the remaining factor of at most 3x properly
+REDUCING_GAP = 3.0
 
 
 class ImageProcessor:
@@ -29,6 +45,7 @@ class ImageProcessor:
         height: Union[int, None] = None,
         keep_aspect_ratio: bool = True,
         legacy_mode=False,
+        resample: Union[Image.Resampling, None] = None,
     ) -> Image.Image:
         if not width and not height:
             return image  # nothing to do
@@ -48,11 +65,35 @@ class ImageProcessor:
 
             return new_image
 
-        new_image = image.resize((width, height), Image.Resampling.LANCZOS)
+        if resample is None:
+            resample = cls.get_resampling_filter(image.size, (width, height))
+
+        new_image = image.resize((width, height), resample, reducing_gap=REDUCING_GAP)
         new_image.format = image.format
 
         return new_image
 
+    @staticmethod
+    def get_resampling_filter(
+        original_size: tuple[int, int], new_size: tuple[int, int]
+    ) -> Image.Resampling:
+        """
+        Picks a cheaper filter the more an image gets scaled down. LANCZOS is a lot more
+        expensive than BOX, but the difference isn't visible at large downscaling ratios.
+        """
+        ratio = max(
+            original_size[0] / new_size[0],
+            original_size[1] / new_size[1],
+        )
+
+        if ratio >= 4:
+            return Image.Resampling.BOX
+
+        if ratio >= 2:
+            return Image.Resampling.BILINEAR
+
+        return Image.Resampling.LANCZOS
+
     @staticmethod
     def calculate_scaled_size(
         original_width: int,
@@ -63,14 +104,16 @@ class ImageProcessor:
         if not width and not height:
             return original_width, original_height  # nothing to do
 
-        # doing my own math, none of this convoluted pillow stuff
-        aspect_ratio = original_width / original_height
+        # when both are given they are used as is, the aspect ratio is not enforced
 
+        # doing my own math, none of this convoluted pillow stuff
+        # integer math avoids float rounding errors, e.g. 1024x1488 scaled to a width
+        # of 512 has to be exactly 744 pixels high and not 743
         if not width:
-            width = int(height * aspect_ratio)
+            width = height * original_width // original_height
 
         if not height:
-            height = int(width / aspect_ratio)
+            height = width * original_height // original_width
 
         return width, height
 
@@ -84,6 +127,7 @@ class ImageProcessor:
         format: str = FORMAT,
         format_save_properties: dict = SAVE_PROPERTIES,
         filename_extension=EXTENSION,
+        variant_dimensions: Iterable[int] = (),
     ) -> tuple[str, ImageMetadata]:
         """
         Generates a new image from an input image with the following properties:
@@ -93,21 +137,28 @@ class ImageProcessor:
         - no EXIF data from the input image
 
         Args:
-            output_path (str): the path to write the image to (filename will be appended)
+            output_path (str): the path to write the image to (filename will be appended),
+                has to exist already
             image (PIL.Image.Image): the image to convert
+            variant_dimensions (Iterable[int]): dimensions to pre-render scaled copies for,
+                reusing the already decoded image (see get_variant_sizes)
         """
 
+        # lets the JPEG decoder scale by 1/2, 1/4 or 1/8 while decoding, which is
+        # a lot cheaper than a full decode followed by a resize (no-op for PNG)
+        image.draft("RGB", cls.get_draft_size(image, MAX_SIZE))
+
         rgb_image = image.convert("RGB")
         ImageOps.exif_transpose(rgb_image, in_place=True)
 
         max_size = MAX_SIZE
 
-        os.makedirs(output_path, exist_ok=True)
-
         id = cls.get_id(data=rgb_image)
 
         # resize after calculating image ID
-        rgb_image = cls.resize(rgb_image, max_size, max_size)
+        rgb_image = cls.resize(
+            rgb_image, max_size, max_size, resample=Image.Resampling.LANCZOS
+        )
 
         filename = os.path.join(
             output_path,
@@ -123,16 +174,76 @@ class ImageProcessor:
         if force_write or not os.path.isfile(filename):
             rgb_image.save(filename, format=format, **format_save_properties)
 
+        for width, height, crop_square in cls.get_variant_sizes(
+            rgb_image.width, rgb_image.height, variant_dimensions
+        ):
+            cls.write_scaled_copy_to_filesystem(
+                id=id,
+                source=rgb_image,
+                output_path=output_path,
+                width=width,
+                height=height,
+                crop_square=crop_square,
+            )
+
         metadata = ImageMetadata(
             original_width=rgb_image.width,
             original_height=rgb_image.height,
-            media_type=Image.MIME.get(format.upper()),
+            media_type=(
+                MEDIA_TYPE if format == FORMAT else Image.MIME.get(format.upper())
+            ),
             format=format,
             extension=filename_extension,
         )
 
         return (id, metadata)
 
+    @classmethod
+    def get_draft_size(cls, image: Image.Image, width: int) -> tuple[int, int]:
+        """
+        Returns the smallest size (in the stored orientation) that an image may be decoded
+        at to still be scaled to the given width after applying its EXIF orientation
+        """
+        displayed_width, displayed_height = image.size
+        # orientations 5 to 8 are rotated by 90 degrees, exif_transpose runs after decoding
+        rotated = image.getexif().get(ExifTags.Base.Orientation, 1) in (5, 6, 7, 8)
+        if rotated:
+            displayed_width, displayed_height = displayed_height, displayed_width
+
+        _, height = cls.calculate_scaled_size(
+            displayed_width, displayed_height, width=width
+        )
+        # very wide images round down to a height of 0, which the decoder can't scale to
+        height = max(height, 1)
+
+        return (height, width) if rotated else (width, height)
+
+    @classmethod
+    def get_variant_sizes(
+        cls, original_width: int, original_height: int, dimensions: Iterable[int]
+    ) -> list[tuple[int, int, bool]]:
+        """
+        Returns the (width, height, crop_square) combinations to pre-render for an image:
+        a copy scaled to each of the given widths and a square crop for each dimension.
+        Sizes that aren't smaller than the original are skipped.
+        """
+        is_square = original_width == original_height
+        sizes = []
+
+        for dimension in dimensions:
+            if dimension < original_width:
+                width, height = cls.calculate_scaled_size(
+                    original_width, original_height, width=dimension
+                )
+                if height > 0:
+                    sizes.append((width, height, False))
+
+            # for square images the scaled copy already is the square crop
+            if not is_square and dimension <= min(original_width, original_height):
+                sizes.append((dimension, dimension, True))
+
+        return sizes
+
     @classmethod
     def write_scaled_copy_from_source_filename_to_filesystem(
         cls,
@@ -144,7 +255,12 @@ class ImageProcessor:
         height: Union[int, None] = None,
         crop_square: bool = False,
     ) -> str:
-        source = Image.open(source_filename)
+        source = cls.load_source(
+            source_filename,
+            # lets the JPEG decoder do most of the downscaling while decoding
+            draft_size=(width, height) if width and height else None,
+        )
+
         return cls.write_scaled_copy_to_filesystem(
             id=id,
             source=source,
@@ -154,6 +270,40 @@ class ImageProcessor:
             crop_square=crop_square,
         )
 
+    @classmethod
+    def load_source(
+        cls,
+        source_filename: str,
+        draft_size: Union[tuple[int, int], None] = None,
+    ) -> Image.Image:
+        """
+        Reads and fully decodes a source image, so the returned image doesn't hold on
+        to the file anymore and can be reused for several scaled copies
+        """
+        with open(source_filename, "rb") as file:
+            cls._advise_sequential_read(file.fileno())
+
+            source = Image.open(file)
+            if draft_size:
+                source.draft("RGB", draft_size)
+            source.load()
+
+        # keep the original filename around, it's used to determine the extension
+        source.filename = source_filename
+        return source
+
+    @staticmethod
+    def _advise_sequential_read(fd: int):
+        """
+        Tells the kernel that the whole file is about to be read from start to end,
+        so it can read ahead more aggressively
+        """
+        if not hasattr(os, "posix_fadvise"):
+            return
+
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+
     @classmethod
     def write_scaled_copy_to_filesystem(
         cls,
@@ -169,7 +319,11 @@ class ImageProcessor:
         if crop_square:
             image = cls._crop_center(source, min(source.size), min(source.size))
 
-        image = cls.resize(image, width, height)
+        # if both dimensions are given they were already calculated from the aspect
+        # ratio, the source might be a slightly differently rounded draft though
+        image = cls.resize(
+            image, width, height, keep_aspect_ratio=not (width and height)
+        )
         image.format = source.format
 
         extension = EXTENSION  # fall back to EXTENSION constant
@@ -187,20 +341,69 @@ class ImageProcessor:
             ),
         )
 
+        save_properties = (
+            THUMBNAIL_SAVE_PROPERTIES
+            if max(image.size) <= THUMBNAIL_MAX_SIZE
+            else SAVE_PROPERTIES
+        )
+
         cls.logger.debug(
-            f"Saving image with id='{id}', filename='{filename}' ({width}x{height}), format={image.format}, save_properties={SAVE_PROPERTIES}"
+            f"Saving image with id='{id}', filename='{filename}' ({width}x{height}), format={image.format}, save_properties={save_properties}"
         )
 
-        image.save(filename, **SAVE_PROPERTIES)
+        image.save(filename, **save_properties)
         return filename
 
-    @staticmethod
-    def get_id(*, data: Image.Image) -> str:
-        pixel_bytes = data.tobytes()
-        hash_input = f"{data.width}_{data.height}".encode("utf-8") + pixel_bytes
-        digest = hashlib.sha256(hash_input).digest()
+    @classmethod
+    def get_id(cls, *, data: Image.Image) -> str:
+        try:
+            hasher = cls._get_id_hasher(data)
+            for chunk in cls._iter_raw_pixel_data(data):
+                hasher.update(chunk)
+        except (AttributeError, RuntimeError):
+            cls.logger.debug(
+                "Streaming pixel data failed, falling back to hashing a full copy",
+                exc_info=True,
+            )
+            hasher = cls._get_id_hasher(data)
+            hasher.update(data.tobytes())
+
+        digest = hasher.digest(length=32)
         return base64.urlsafe_b64encode(digest).decode("ascii").rstrip("=")
 
+    @staticmethod
+    def _get_id_hasher(data: Image.Image) -> blake3:
+        # blake3 hashes using SIMD and (for large inputs) multiple threads,
+        # which is a lot faster than sha256 on full resolution pixel data
+        hasher = blake3(max_threads=blake3.AUTO)
+        hasher.update(f"{data.width}_{data.height}".encode("utf-8"))
+        return hasher
+
+    @staticmethod
+    def _iter_raw_pixel_data(data: Image.Image, rows_per_chunk: int = 64):
+        """
+        Yields the same bytes as Image.tobytes() in chunks of a few rows, without
+        ever materializing a full copy of the pixel data.
+        """
+        data.load()
+
+        if data.width == 0 or data.height == 0:
+            return
+
+        encoder = Image._getencoder(data.mode, "raw", data.mode)
+        encoder.setimage(data.im, (0, 0) + data.size)
+
+        bufsize = data.width * len(data.getbands()) * rows_per_chunk
+
+        while True:
+            _, status, chunk = encoder.encode(bufsize)
+            yield chunk
+            if status:
+                break
+
+        if status < 0:
+            raise RuntimeError(f"Encoder error {status} while reading pixel data")
+
     @staticmethod
     # https://note.nkmk.me/en/python-pillow-square-circle-thumbnail/
     # Thanks!
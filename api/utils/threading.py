@@ -1,10 +1,8 @@
 from threading import Lock
-from time import sleep
 
 
 class ThreadingUtils:
     @staticmethod
     def wait_and_acquire_lock(lock: Lock):
-        while lock.locked():
-            sleep(0.001)
+        # blocks until the lock is free, without polling it
         lock.acquire()
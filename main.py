@@ -1,29 +1,39 @@
 import asyncio
 from contextlib import asynccontextmanager
+from dataclasses import replace
+from functools import lru_cache
 import logging
 import hashlib
+import math
 import os
 import time
 import traceback
-from typing import Union, Annotated
+from typing import BinaryIO, Union, Annotated
 import crawleruseragents
 import shutil
 from fastapi import APIRouter, FastAPI, HTTPException, Request, UploadFile, Form
 from fastapi.responses import FileResponse, HTMLResponse, JSONResponse
 from fastapi.templating import Jinja2Templates
+from markupsafe import escape
+from jinja2 import (
+    Environment,
+    FileSystemBytecodeCache,
+    FileSystemLoader,
+    select_autoescape,
+)
 from fastapi.exception_handlers import http_exception_handler
 from http import HTTPStatus
 from kaesebrot_commons.logging.utils import LoggingUtils
-from io import BytesIO
 from PIL import Image, UnidentifiedImageError
 from pathlib import Path
 
 from api.cache import Cache
 from api.classes import (
+    Config,
     FaviconResponse,
     HealthCheckResponse,
+    ImageFileResponse,
     ImagePageResponse,
-    ResolutionVariant,
     StaticFilesCustomHeaders,
     TemplateResolutionMetadata,
 )
@@ -34,38 +44,18 @@ ENV_PREFIX = "RANDHAJ"
 
 STATIC_EXTERNAL_CACHING_TIME = 365 * 24 * 60 * 60  # 365 days in seconds
 IMAGE_FILES_CACHING_TIME = 30 * 24 * 60 * 60  # 30 days in seconds
+# not immutable, the site emoji can be changed by the configuration
+FAVICON_CACHING_TIME = 24 * 60 * 60  # 1 day in seconds
 
 API_PAGE_SIZE_LIMIT = 200
 VIEW_PAGE_SIZE_LIMIT = 50
 
 ALLOWED_MAX_UPLOAD_FILE_SIZE = 4 * 1024 * 1024
 ALLOWED_UPLOAD_CONTENT_TYPES = ["image/png", "image/jpeg"]
+# checked on every image request
+ALLOWED_DIMENSIONS = frozenset(Constants.ALLOWED_DIMENSIONS)
 
-version = os.getenv("APP_VERSION", "0.0.1")
-source_image_dir = os.getenv(f"{ENV_PREFIX}_IMAGE_DIR", "assets/images")
-cache_dir = os.getenv(f"{ENV_PREFIX}_CACHE_DIR", "cache")
-cache_db_file = os.getenv(
-    f"{ENV_PREFIX}_CACHE_DB_FILE", f"{cache_dir.rstrip('/')}/.randhaj-cache.db"
-)
-submissions_dir = os.getenv(f"{ENV_PREFIX}_SUBMISSIONS_DIR", "submissions")
-max_submissions_usage = float(
-    os.getenv(f"{ENV_PREFIX}_SUBMISSIONS_DIR_DISK_USAGE_LIMIT", "0.9")
-)
-site_title = os.getenv(f"{ENV_PREFIX}_SITE_TITLE", "Random image")
-site_emoji = os.getenv(f"{ENV_PREFIX}_SITE_EMOJI", "🦈")
-default_card_image_id = os.getenv(f"{ENV_PREFIX}_DEFAULT_CARD_IMAGE")
-max_initial_cache_generator_workers = int(
-    os.getenv(f"{ENV_PREFIX}_MAX_INITIAL_CACHE_GENERATOR_WORKERS", 4)
-)
-loglevel = os.getenv(
-    f"{ENV_PREFIX}_LOG_LEVEL", os.getenv("UVICORN_LOG_LEVEL", logging.INFO)
-)
-
-LoggingUtils.setup_logging_with_default_formatter(loglevel=loglevel)
-
-for name in logging.root.manager.loggerDict.keys():
-    logging.getLogger(name).handlers = []
-    logging.getLogger(name).propagate = True
+DISK_USAGE_REFRESH_INTERVAL = 10  # seconds
 
 tags_metadata = [
     {
@@ -78,19 +68,108 @@ tags_metadata = [
     },
 ]
 
-cache = Cache(
-    image_dir=source_image_dir,
-    cache_dir=cache_dir,
-    max_initial_cache_generator_workers=max_initial_cache_generator_workers,
-    connection_string=f"sqlite:///{cache_db_file}",
-)
+
+def load_config_and_cache() -> tuple[Config, Cache]:
+    """
+    Reads the configuration from the environment. The default card image falls back to
+    the first cached image, so the cache is created before the configuration is complete
+    """
+    loglevel = os.getenv(
+        f"{ENV_PREFIX}_LOG_LEVEL", os.getenv("UVICORN_LOG_LEVEL", logging.INFO)
+    )
+    LoggingUtils.setup_logging_with_default_formatter(loglevel=loglevel)
+
+    for name in logging.root.manager.loggerDict.keys():
+        logging.getLogger(name).handlers = []
+        logging.getLogger(name).propagate = True
+
+    source_image_dir = os.getenv(f"{ENV_PREFIX}_IMAGE_DIR", "assets/images")
+    cache_dir = os.getenv(f"{ENV_PREFIX}_CACHE_DIR", "cache")
+    cache_db_file = os.getenv(
+        f"{ENV_PREFIX}_CACHE_DB_FILE", f"{cache_dir.rstrip('/')}/.randhaj-cache.db"
+    )
+    max_initial_cache_generator_workers = int(
+        os.getenv(f"{ENV_PREFIX}_MAX_INITIAL_CACHE_GENERATOR_WORKERS", 4)
+    )
+    decoded_source_cache_size = int(
+        os.getenv(f"{ENV_PREFIX}_DECODED_SOURCE_CACHE_SIZE", 16)
+    )
+
+    cache = Cache(
+        image_dir=source_image_dir,
+        cache_dir=cache_dir,
+        max_initial_cache_generator_workers=max_initial_cache_generator_workers,
+        connection_string=f"sqlite:///{cache_db_file}",
+        decoded_source_cache_size=decoded_source_cache_size,
+    )
+
+    config = Config(
+        version=os.getenv("APP_VERSION", "0.0.1"),
+        source_image_dir=source_image_dir,
+        cache_dir=cache_dir,
+        cache_db_file=cache_db_file,
+        submissions_dir=os.getenv(f"{ENV_PREFIX}_SUBMISSIONS_DIR", "submissions"),
+        max_submissions_usage=float(
+            os.getenv(f"{ENV_PREFIX}_SUBMISSIONS_DIR_DISK_USAGE_LIMIT", "0.9")
+        ),
+        site_title=os.getenv(f"{ENV_PREFIX}_SITE_TITLE", "Random image"),
+        site_emoji=os.getenv(f"{ENV_PREFIX}_SITE_EMOJI", "🦈"),
+        default_card_image_id=os.getenv(f"{ENV_PREFIX}_DEFAULT_CARD_IMAGE")
+        or cache.get_first_id(),
+        max_initial_cache_generator_workers=max_initial_cache_generator_workers,
+        decoded_source_cache_size=decoded_source_cache_size,
+        loglevel=loglevel,
+    )
+    return config, cache
+
+
+CFG, cache = load_config_and_cache()
+# the cache creates its own directory, submitted images are written directly
+os.makedirs(CFG.submissions_dir, exist_ok=True)
 cache_start = None
+cache_ready = False
+disk_usage_refresh = None
+
+
+def get_submissions_disk_usage() -> float:
+    total, used, free = shutil.disk_usage(
+        Path(CFG.submissions_dir).absolute().as_posix()
+    )
+    return used / total
+
+
+submissions_disk_usage = get_submissions_disk_usage()
+
+
+async def refresh_submissions_disk_usage():
+    global submissions_disk_usage
+    while True:
+        await asyncio.sleep(DISK_USAGE_REFRESH_INTERVAL)
+        # keep the last value on errors instead of letting the task die with a stale one
+        try:
+            submissions_disk_usage = await asyncio.to_thread(get_submissions_disk_usage)
+        except Exception:
+            logging.getLogger(__name__).exception(
+                f"Failed refreshing the disk usage of '{CFG.submissions_dir}', retrying in {DISK_USAGE_REFRESH_INTERVAL}s"
+            )
+
+
+async def start_cache():
+    global cache_ready
+    try:
+        await cache.start()
+    finally:
+        # checked by every request, a plain bool is cheaper than polling the task
+        cache_ready = True
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global cache_start
-    cache_start = asyncio.create_task(cache.start())
+    global cache_start, disk_usage_refresh
+    cache_start = asyncio.create_task(start_cache())
+    disk_usage_refresh = asyncio.create_task(refresh_submissions_disk_usage())
     yield
+    disk_usage_refresh.cancel()
     cache_start.cancel()
     try:
         await cache_start
@@ -101,8 +180,8 @@ async def lifespan(app: FastAPI):
 
 
 app = FastAPI(
-    title=site_title,
-    version=version,
+    title=CFG.site_title,
+    version=CFG.version,
     license_info={
         "name": "GPL-2.0",
         "url": "https://github.com/das-kaesebrot/randhaj/blob/main/LICENSE",
@@ -120,7 +199,19 @@ app.mount(
     ),
     name="static_external",
 )
-templates = Jinja2Templates(directory="resources/templates")
+# templates don't change while the app is running, so they're compiled once
+# and never checked for changes on the filesystem again
+templates = Jinja2Templates(
+    env=Environment(
+        loader=FileSystemLoader("resources/templates"),
+        autoescape=select_autoescape(),
+        auto_reload=False,
+        cache_size=-1,
+        bytecode_cache=FileSystemBytecodeCache(),
+    )
+)
+for template_name in templates.env.list_templates(extensions=("html", "svg")):
+    templates.get_template(template_name)
 
 with open("resources/static/randhaj.css", "rb") as f:
     css_hash = hashlib.sha256(f.read()).hexdigest()
@@ -129,26 +220,53 @@ templates.env.globals["css_version"] = css_hash
 api_router = APIRouter(tags=["api"])
 view_router = APIRouter(tags=["view"], default_response_class=HTMLResponse)
 
-if not default_card_image_id:
-    default_card_image_id = cache.get_first_id()
+# the same for every page, escaped once here instead of by Jinja on every render
+_BASE_CONTEXT = {
+    key: escape(value) if isinstance(value, str) else value
+    for key, value in {
+        "site_emoji": CFG.site_emoji,
+        "site_title": CFG.site_title,
+        "version": CFG.version,
+        "default_card_image_id": CFG.default_card_image_id,
+        "thumbnail_width": Constants.get_small_thumbnail_width(),
+        "background_image_width": Constants.get_background_width(),
+    }.items()
+}
 
+FAVICON_CONTENT = (
+    '<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 100 100">'
+    + f'<text y=".9em" font-size="90">{CFG.site_emoji}</text>'
+    + "</svg>"
+).encode("utf-8")
+
+
+_UNIT_PREFIX = ("n", "μ", "m", "", "k", "M", "G")
+
+
+@lru_cache(maxsize=4096)
+def is_crawler(user_agent: str) -> bool:
+    # crawlers send the same few user agents over and over again
+    return crawleruseragents.is_crawler(user_agent=user_agent)
 
-def ns_to_duration_str(ns: int) -> str:
-    unit_prefix = ["n", "μ", "m", "", "k", "M", "G"]
-    duration = ns
-    iteration = 0
 
-    while duration >= 1000:
-        duration /= 1000
-        iteration += 1
+# compiles the crawler patterns now instead of on the first request
+is_crawler("")
 
-        if iteration >= len(unit_prefix) - 1:
-            iteration = len(unit_prefix) - 1
 
-    return f"{duration:.2f} {unit_prefix[iteration]}s"
+@lru_cache(maxsize=8192)
+def get_cached_file_stat(filename: str) -> os.stat_result:
+    # cached images are written once and never modified afterwards
+    return os.stat(filename)
 
 
-def get_file_response(
+def ns_to_duration_str(ns: int) -> str:
+    iteration = min(int(math.log10(max(ns, 1))) // 3, len(_UNIT_PREFIX) - 1)
+    duration = ns / 1000**iteration
+
+    return f"{duration:.2f} {_UNIT_PREFIX[iteration]}s"
+
+
+async def get_file_response(
     *,
     image_id: str,
     width: Union[int, None] = None,
@@ -156,46 +274,47 @@ def get_file_response(
     download: bool = False,
     enable_cache: bool = True,
     square: bool = False,
-) -> FileResponse:
-    if not cache.id_exists(image_id):
+) -> ImageFileResponse:
+    metadata = await cache.aget_metadata(image_id)
+    if not metadata:
         raise HTTPException(
             status_code=HTTPStatus.NOT_FOUND,
             detail=f"File with id='{image_id}' could not be found!",
         )
 
-    metadata = cache.get_metadata(image_id)
-
     if square:
         if not width:
             width = Constants.get_max_width()
         height = width
 
-    if not height and width and width not in Constants.ALLOWED_DIMENSIONS:
+    if not height and width and width not in ALLOWED_DIMENSIONS:
         _, height = ImageProcessor.calculate_scaled_size(
-            original_width=metadata.original_width,
-            original_height=metadata.original_height,
+            metadata.original_width,
+            metadata.original_height,
             width=width,
         )
-        if height not in Constants.ALLOWED_DIMENSIONS:
+        if height not in ALLOWED_DIMENSIONS:
             raise HTTPException(
                 status_code=HTTPStatus.BAD_REQUEST,
                 detail="Width is not of allowed value!",
             )
 
-    if not width and height and height not in Constants.ALLOWED_DIMENSIONS:
+    if not width and height and height not in ALLOWED_DIMENSIONS:
         width, _ = ImageProcessor.calculate_scaled_size(
-            original_width=metadata.original_width,
-            original_height=metadata.original_height,
+            metadata.original_width,
+            metadata.original_height,
             height=height,
         )
 
-        if width not in Constants.ALLOWED_DIMENSIONS:
+        if width not in ALLOWED_DIMENSIONS:
             raise HTTPException(
                 status_code=HTTPStatus.BAD_REQUEST,
                 detail="Height is not of allowed value!",
             )
 
-    filename = cache.get_filename(image_id, width=width, height=height, square=square)
+    filename = await cache.aget_filename(
+        image_id, width=width, height=height, square=square
+    )
 
     headers = {
         "Content-Disposition": (
@@ -213,73 +332,51 @@ def get_file_response(
     else:
         headers["Cache-Control"] = "no-store"
 
-    return FileResponse(
+    return ImageFileResponse(
         path=filename,
         media_type=metadata.media_type,
         headers=headers,
+        stat_result=get_cached_file_stat(filename),
     )
 
 
-def get_image_page_response(
+async def get_image_page_response(
     request: Request, image_id: str, is_direct_request: bool = False
 ) -> HTMLResponse:
     start = time.perf_counter_ns()
-    if not cache.id_exists(image_id):
+    metadata = await cache.aget_metadata(image_id)
+    if not metadata:
         raise HTTPException(
             status_code=HTTPStatus.NOT_FOUND,
             detail=f"Image with id='{image_id}' could not be found!",
         )
 
-    if crawleruseragents.is_crawler(user_agent=request.headers.get("user-agent")):
+    if is_crawler(request.headers.get("user-agent", "")):
         return templates.TemplateResponse(
             request=request,
             name="base.html",
             context={
-                "site_emoji": site_emoji,
-                "site_title": site_title,
+                **_BASE_CONTEXT,
                 "image_id": image_id,
                 "is_direct_request": is_direct_request,
-                "default_card_image_id": default_card_image_id,
-                "thumbnail_width": Constants.get_small_thumbnail_width(),
             },
         )
 
     current_width = Constants.get_default_width()
-    metadata = cache.get_metadata(image_id)
     current_width, current_height = ImageProcessor.calculate_scaled_size(
-        original_width=metadata.original_width,
-        original_height=metadata.original_height,
+        metadata.original_width,
+        metadata.original_height,
         width=current_width,
     )
-    filename = cache.get_filename(image_id, width=current_width, height=current_height)
+    filename = await cache.aget_filename(
+        image_id, width=current_width, height=current_height
+    )
     filename = os.path.basename(filename)
 
-    variants = []
-    for width in sorted(Constants.ALLOWED_DIMENSIONS, reverse=True):
-        width, height = ImageProcessor.calculate_scaled_size(
-            original_width=metadata.original_width,
-            original_height=metadata.original_height,
-            width=width,
-        )
-        current = False
-
-        if width == current_width:
-            current = True
-
-        filename = os.path.basename(
-            cache.get_filename(
-                id=image_id,
-                width=width,
-                height=height,
-                square=False,
-                only_get_filename=True,
-            )
-        )
-        variants.append(
-            ResolutionVariant(
-                width=width, height=height, current=current, filename=filename
-            )
-        )
+    variants = [
+        replace(variant, current=True) if variant.width == current_width else variant
+        for variant in cache.get_variant_ladder(image_id)
+    ]
 
     resolution_data = TemplateResolutionMetadata(
         current_width=current_width,
@@ -291,24 +388,19 @@ def get_image_page_response(
         request=request,
         name="image.html",
         context={
-            "site_emoji": site_emoji,
-            "site_title": site_title,
+            **_BASE_CONTEXT,
             "image_id": image_id,
             "image_filename": filename,
-            "version": version,
             "resolution_data": resolution_data,
             "is_direct_request": is_direct_request,
-            "default_card_image_id": default_card_image_id,
-            "thumbnail_width": Constants.get_small_thumbnail_width(),
             "nav_page": "image",
             "request_duration": ns_to_duration_str(time.perf_counter_ns() - start),
             "background_image_id": image_id,
-            "background_image_width": Constants.get_background_width(),
         },
     )
 
 
-def get_gallery_page_response(
+async def get_gallery_page_response(
     request: Request,
     page: int = 1,
     page_size=VIEW_PAGE_SIZE_LIMIT,
@@ -325,25 +417,26 @@ def get_gallery_page_response(
             detail=f"Page size can't be bigger than {VIEW_PAGE_SIZE_LIMIT}!",
         )
 
-    page_max = (cache.get_total_image_count() // page_size) + 1
+    page_max = max(1, -(-cache.get_total_image_count() // page_size))
     if page > page_max:
         raise HTTPException(
             status_code=HTTPStatus.BAD_REQUEST,
             detail=f"Page can't be bigger than {page_max}!",
         )
 
-    ids = cache.get_ids_paged(page=page - 1, page_size=page_size)
+    ids = await asyncio.to_thread(
+        cache.get_ids_paged, page=page - 1, page_size=page_size
+    )
+    # the browser requests all thumbnails right after, make sure their metadata
+    # is already cached instead of looking it up once per thumbnail request
+    await cache.aget_metadata_batch(ids)
     current_width = Constants.get_small_thumbnail_width()
 
     return templates.TemplateResponse(
         request=request,
         name="gallery.html",
         context={
-            "site_emoji": site_emoji,
-            "site_title": site_title,
-            "version": version,
-            "default_card_image_id": default_card_image_id,
-            "thumbnail_width": Constants.get_small_thumbnail_width(),
+            **_BASE_CONTEXT,
             "image_ids": ids,
             "current_width": current_width,
             "page_num": page,
@@ -351,8 +444,7 @@ def get_gallery_page_response(
             "page_size": page_size,
             "nav_page": "gallery",
             "request_duration": ns_to_duration_str(time.perf_counter_ns() - start),
-            "background_image_id": default_card_image_id,
-            "background_image_width": Constants.get_background_width(),
+            "background_image_id": CFG.default_card_image_id,
         },
     )
 
@@ -366,14 +458,10 @@ def get_submit_page_response(
         request=request,
         name="submit.html",
         context={
-            "site_emoji": site_emoji,
-            "site_title": site_title,
-            "version": version,
-            "default_card_image_id": default_card_image_id,
+            **_BASE_CONTEXT,
             "nav_page": "submit",
             "request_duration": ns_to_duration_str(time.perf_counter_ns() - start),
-            "background_image_id": default_card_image_id,
-            "background_image_width": Constants.get_background_width(),
+            "background_image_id": CFG.default_card_image_id,
         },
     )
 
@@ -382,10 +470,9 @@ def get_submit_page_response(
     "/favicon.ico", summary="Returns the favicon", response_class=FaviconResponse
 )
 async def get_favicon():
-    return (
-        '<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 100 100">'
-        + f'<text y=".9em" font-size="90">{site_emoji}</text>'
-        + "</svg>"
+    return FaviconResponse(
+        content=FAVICON_CONTENT,
+        headers={"Cache-Control": f"max-age={FAVICON_CACHING_TIME}, public"},
     )
 
 
@@ -393,8 +480,8 @@ async def get_favicon():
     "/", summary="Returns the page for a random image", response_class=HTMLResponse
 )
 async def page_redirect_rand_image(request: Request):
-    image_id = cache.get_random_id()
-    return get_image_page_response(request, image_id)
+    image_id = await asyncio.to_thread(cache.get_random_id)
+    return await get_image_page_response(request, image_id)
 
 
 @view_router.get(
@@ -403,7 +490,7 @@ async def page_redirect_rand_image(request: Request):
     response_class=HTMLResponse,
 )
 async def page_get_gallery(request: Request, page: int = 1, page_size: int = 50):
-    return get_gallery_page_response(request, page, page_size)
+    return await get_gallery_page_response(request, page, page_size)
 
 
 @view_router.get(
@@ -415,6 +502,18 @@ async def page_get_submit(request: Request):
     return get_submit_page_response(request)
 
 
+def convert_submission(contents: BinaryIO) -> str:
+    with Image.open(contents) as image:
+        id, _ = ImageProcessor.convert_to_unified_format_and_write_to_filesystem(
+            output_path=CFG.submissions_dir,
+            image=image,
+            format_save_properties={"quality": 100},
+            filename_prefix="submission",
+        )
+
+    return id
+
+
 @view_router.post(
     "/submit",
     summary="Submits a new image.",
@@ -443,9 +542,8 @@ async def page_post_submit(
             detail=f"Image has to have a content type of {ALLOWED_UPLOAD_CONTENT_TYPES}",
         )
 
-    total, used, free = shutil.disk_usage(Path(submissions_dir).absolute().as_posix())
-    used_amount = used / total
-    if used_amount > max_submissions_usage:
+    # refreshed in the background, statvfs can block for a while on network filesystems
+    if submissions_disk_usage > CFG.max_submissions_usage:
         raise HTTPException(
             status_code=HTTPStatus.INTERNAL_SERVER_ERROR,
             detail=f"Disk usage is above allowed amount!",
@@ -454,16 +552,9 @@ async def page_post_submit(
     id = None
     try:
         await file.seek(0)
-        contents = BytesIO(await file.read())
-        with Image.open(contents) as image:
-            id, metadata = (
-                ImageProcessor.convert_to_unified_format_and_write_to_filesystem(
-                    output_path=submissions_dir,
-                    image=image,
-                    format_save_properties={"quality": 100},
-                    filename_prefix="submission",
-                )
-            )
+        # the upload is already spooled to a temporary file, so let Pillow read it
+        # from there instead of copying it into memory first
+        id = await asyncio.to_thread(convert_submission, file.file)
     except UnidentifiedImageError as e:
         raise HTTPException(
             status_code=HTTPStatus.BAD_REQUEST,
@@ -474,14 +565,10 @@ async def page_post_submit(
         request=request,
         name="submit-success.html",
         context={
-            "site_emoji": site_emoji,
-            "site_title": site_title,
-            "version": version,
+            **_BASE_CONTEXT,
             "submitted_image_id": id,
-            "default_card_image_id": default_card_image_id,
             "nav_page": "submit",
-            "background_image_id": default_card_image_id,
-            "background_image_width": Constants.get_background_width(),
+            "background_image_id": CFG.default_card_image_id,
         },
     )
 
@@ -492,7 +579,7 @@ async def page_post_submit(
     response_class=HTMLResponse,
 )
 async def page_get_image(request: Request, image_id: str):
-    return get_image_page_response(request, image_id, is_direct_request=True)
+    return await get_image_page_response(request, image_id, is_direct_request=True)
 
 
 @api_router.get(
@@ -503,8 +590,8 @@ async def api_get_rand_image(
     height: Union[int, None] = None,
     download: bool = False,
 ) -> FileResponse:
-    image_id = cache.get_random_id()
-    return get_file_response(
+    image_id = await asyncio.to_thread(cache.get_random_id)
+    return await get_file_response(
         image_id=image_id,
         width=width,
         height=height,
@@ -528,7 +615,7 @@ async def api_get_image(
     if image_id.endswith(f".{Constants.DEFAULT_EXTENSION}"):
         image_id = image_id.rstrip(f".{Constants.DEFAULT_EXTENSION}")
 
-    return get_file_response(
+    return await get_file_response(
         image_id=image_id,
         width=width,
         height=height,
@@ -550,9 +637,8 @@ async def api_get_image_ids_paged(
             status_code=HTTPStatus.BAD_REQUEST,
             detail=f"Page size can't be bigger than {API_PAGE_SIZE_LIMIT}!",
         )
-    return ImagePageResponse(
-        offset=offset, ids=cache.get_ids_paged_with_offset(offset, page_size)
-    )
+    ids = await asyncio.to_thread(cache.get_ids_paged_with_offset, offset, page_size)
+    return ImagePageResponse(offset=offset, ids=ids)
 
 
 @api_router.get("/health", summary="Returns service health")
@@ -568,23 +654,23 @@ app.include_router(view_router)
 async def http_exception_handler_with_view_handling(request, exc: HTTPException):
     if "view" in request.scope.get("route").tags:
         http_status = HTTPStatus(exc.status_code)
-        traceback_str = "\n".join(
-            traceback.format_exception(type(exc), value=exc, tb=exc.__traceback__)
-        )
+        traceback_str = ""
+        # client errors are expected (e.g. bots probing for pages), formatting
+        # their stack would only cost time
+        if http_status >= HTTPStatus.INTERNAL_SERVER_ERROR:
+            traceback_str = "\n".join(
+                traceback.format_exception(type(exc), value=exc, tb=exc.__traceback__)
+            )
         return templates.TemplateResponse(
             request=request,
             name="error.html",
             context={
-                "site_emoji": site_emoji,
-                "site_title": site_title,
-                "version": version,
-                "default_card_image_id": default_card_image_id,
+                **_BASE_CONTEXT,
                 "http_status": http_status,
                 "exception": exc,
                 "traceback_str": traceback_str,
                 "request": request,
-                "background_image_id": default_card_image_id,
-                "background_image_width": Constants.get_background_width(),
+                "background_image_id": CFG.default_card_image_id,
             },
             status_code=http_status,
         )
@@ -594,25 +680,25 @@ async def http_exception_handler_with_view_handling(request, exc: HTTPException)
 
 @app.middleware("http")
 async def intercept_requests_on_startup(request: Request, call_next):
-    if cache_start is None or not cache_start.done():
-        path = request.scope.get("path")
-        if path.startswith("/api/v1"):
-            return JSONResponse(
-                content={"status": "starting"},
-                status_code=HTTPStatus.SERVICE_UNAVAILABLE,
-            )
-        if not path.startswith(("/static/dist", "/favicon.ico")):
-            return templates.TemplateResponse(
-                request=request,
-                name="startup.html",
-                context={
-                    "site_emoji": site_emoji,
-                    "site_title": site_title,
-                    "version": version,
-                    "request": request,
-                    "url": str(request.url),
-                },
-                status_code=HTTPStatus.SERVICE_UNAVAILABLE,
-            )
+    if cache_ready:
+        return await call_next(request)
+
+    path = request.scope.get("path")
+    if path.startswith("/api/v1"):
+        return JSONResponse(
+            content={"status": "starting"},
+            status_code=HTTPStatus.SERVICE_UNAVAILABLE,
+        )
+    if not path.startswith(("/static/dist", "/favicon.ico")):
+        return templates.TemplateResponse(
+            request=request,
+            name="startup.html",
+            context={
+                **_BASE_CONTEXT,
+                "request": request,
+                "url": str(request.url),
+            },
+            status_code=HTTPStatus.SERVICE_UNAVAILABLE,
+        )
 
     return await call_next(request)
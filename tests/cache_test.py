@@ -0,0 +1,266 @@
+import asyncio
+import logging
+import shutil
+import time
+import struct
+import zlib
+
+import pytest
+from PIL import Image
+from api.cache import Cache, _is_source_image_filename
+from api.utils.image import ImageProcessor
+
+
+def write_decompression_bomb_png(path: str):
+    # a PNG header claiming 20000x20000 pixels, Pillow refuses to open it with a
+    # DecompressionBombError (which isn't an OSError) before decoding anything
+    def chunk(chunk_type: bytes, data: bytes) -> bytes:
+        return (
+            struct.pack(">I", len(data))
+            + chunk_type
+            + data
+            + struct.pack(">I", zlib.crc32(chunk_type + data))
+        )
+
+    with open(path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(chunk(b"IHDR", struct.pack(">IIBBBBB", 20000, 20000, 8, 2, 0, 0, 0)))
+        f.write(chunk(b"IDAT", zlib.compress(b"\0")))
+        f.write(chunk(b"IEND", b""))
+
+
+def test_startup_should_skip_broken_images_and_cache_the_rest(tmp_path):
+    image_dir = tmp_path / "images"
+    image_dir.mkdir()
+    write_decompression_bomb_png(str(image_dir / "broken.png"))
+    Image.new("RGB", (64, 48), color="red").save(image_dir / "good.png")
+
+    cache = Cache(
+        image_dir=str(image_dir),
+        cache_dir=str(tmp_path / "cache"),
+        enable_inotify=False,
+        max_initial_cache_generator_workers=1,
+    )
+    try:
+        asyncio.run(cache.start())
+
+        assert cache.get_total_image_count() == 1
+        assert cache.exists_by_original_filename("good.png")
+        assert not cache.exists_by_original_filename("broken.png")
+    finally:
+        cache.stop()
+
+
+def test_startup_should_ignore_dotfiles_like_the_watcher(tmp_path):
+    image_dir = tmp_path / "images"
+    image_dir.mkdir()
+    Image.new("RGB", (64, 48), color="red").save(image_dir / "._photo.png")
+    Image.new("RGB", (64, 48), color="red").save(image_dir / "photo.png")
+
+    cache = Cache(
+        image_dir=str(image_dir),
+        cache_dir=str(tmp_path / "cache"),
+        enable_inotify=False,
+        max_initial_cache_generator_workers=1,
+    )
+    try:
+        asyncio.run(cache.start())
+
+        assert cache.exists_by_original_filename("photo.png")
+        assert not cache.exists_by_original_filename("._photo.png")
+    finally:
+        cache.stop()
+
+
+@pytest.mark.parametrize("decoded_source_cache_size", [0, 16])
+def test_cache_miss_should_render_the_requested_size(
+    tmp_path, decoded_source_cache_size
+):
+    image_dir = tmp_path / "images"
+    image_dir.mkdir()
+    Image.new("RGB", (800, 600), color="red").save(image_dir / "photo.jpg")
+
+    cache = Cache(
+        image_dir=str(image_dir),
+        cache_dir=str(tmp_path / "cache"),
+        enable_inotify=False,
+        max_initial_cache_generator_workers=1,
+        decoded_source_cache_size=decoded_source_cache_size,
+    )
+    try:
+        asyncio.run(cache.start())
+        (id,) = cache.get_all_ids()
+
+        with Image.open(cache.get_filename(id, width=100)) as image:
+            assert image.size == (100, 75)
+        with Image.open(cache.get_filename(id, width=120, square=True)) as image:
+            assert image.size == (120, 120)
+    finally:
+        cache.stop()
+
+
+def test_metadata_batch_should_not_leave_the_event_loop_when_cached(
+    tmp_path, monkeypatch
+):
+    image_dir = tmp_path / "images"
+    image_dir.mkdir()
+    Image.new("RGB", (64, 48), color="red").save(image_dir / "photo.png")
+
+    cache = Cache(
+        image_dir=str(image_dir),
+        cache_dir=str(tmp_path / "cache"),
+        enable_inotify=False,
+        max_initial_cache_generator_workers=1,
+    )
+    try:
+        asyncio.run(cache.start())
+        ids = cache.get_all_ids()
+
+        def fail(*args, **kwargs):
+            raise AssertionError("metadata is preloaded, no thread should be needed")
+
+        monkeypatch.setattr(asyncio, "to_thread", fail)
+        metadata_by_id = asyncio.run(cache.aget_metadata_batch(ids))
+
+        assert list(metadata_by_id) == list(ids)
+    finally:
+        cache.stop()
+
+
+@pytest.mark.parametrize(
+    "filename, expected",
+    [
+        ("photo.jpg", True),
+        ("PHOTO.JPEG", True),
+        ("photo.png", True),
+        ("photo.jpg.part", False),
+        ("photo.tmp", False),
+        ("._photo.jpg", False),
+        # no extension at all, only the last character used to be compared
+        ("jpg", False),
+        ("png", False),
+    ],
+)
+def test_source_image_filename_check(filename, expected):
+    assert _is_source_image_filename(filename) == expected
+
+
+def wait_for(condition, timeout: float = 10.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def test_watcher_should_survive_broken_and_duplicate_files(tmp_path, caplog):
+    image_dir = tmp_path / "images"
+    image_dir.mkdir()
+    Image.new("RGB", (64, 48), color="red").save(image_dir / "photo.png")
+
+    cache = Cache(
+        image_dir=str(image_dir),
+        cache_dir=str(tmp_path / "cache"),
+        max_initial_cache_generator_workers=1,
+    )
+    caplog.set_level(logging.INFO, logger="api.cache.inotify-thread")
+    try:
+        asyncio.run(cache.start())
+        # the watch is added by the inotify thread, files written before that are missed
+        assert wait_for(lambda: "Added watch" in caplog.text)
+
+        write_decompression_bomb_png(str(image_dir / "broken.png"))
+        # same pixels as an already cached image, so the same ID
+        shutil.copy(image_dir / "photo.png", image_dir / "copy.png")
+        Image.new("RGB", (64, 48), color="blue").save(image_dir / "new.png")
+
+        assert wait_for(lambda: cache.get_total_image_count() == 2)
+        assert cache.exists_by_original_filename("new.png")
+        assert cache._inotify_thread.is_alive()
+    finally:
+        cache.stop()
+
+
+def test_concurrent_cache_misses_should_share_one_render(tmp_path, monkeypatch):
+    image_dir = tmp_path / "images"
+    image_dir.mkdir()
+    Image.new("RGB", (800, 600), color="red").save(image_dir / "photo.jpg")
+
+    cache = Cache(
+        image_dir=str(image_dir),
+        cache_dir=str(tmp_path / "cache"),
+        enable_inotify=False,
+        max_initial_cache_generator_workers=1,
+    )
+    renders = []
+    write_scaled_copy = ImageProcessor.write_scaled_copy_to_filesystem
+
+    def slow_write_scaled_copy(**kwargs):
+        renders.append(kwargs["width"])
+        # keep the render running until all requests are waiting for it
+        time.sleep(0.2)
+        return write_scaled_copy(**kwargs)
+
+    async def request_concurrently(id: str) -> list[str]:
+        return await asyncio.gather(
+            *(cache.aget_filename(id, width=100) for _ in range(4))
+        )
+
+    try:
+        asyncio.run(cache.start())
+        (id,) = cache.get_all_ids()
+        monkeypatch.setattr(
+            ImageProcessor, "write_scaled_copy_to_filesystem", slow_write_scaled_copy
+        )
+
+        filenames = asyncio.run(request_concurrently(id))
+
+        assert renders == [100]
+        assert len(set(filenames)) == 1
+        assert not cache._pending_renders
+    finally:
+        cache.stop()
+
+
+def test_deleted_image_should_stay_deleted_after_restart(tmp_path):
+    image_dir = tmp_path / "images"
+    image_dir.mkdir()
+    Image.new("RGB", (64, 48), color="red").save(image_dir / "photo.png")
+    Image.new("RGB", (64, 48), color="blue").save(image_dir / "other.png")
+
+    def run_cache(check):
+        cache = Cache(
+            image_dir=str(image_dir),
+            cache_dir=str(tmp_path / "cache"),
+            enable_inotify=False,
+            max_initial_cache_generator_workers=1,
+            connection_string=f"sqlite:///{tmp_path}/db.sqlite",
+        )
+        try:
+            asyncio.run(cache.start())
+            check(cache)
+        finally:
+            cache.stop()
+
+    with Image.open(image_dir / "photo.png") as image:
+        photo_id = ImageProcessor.get_id(data=image)
+
+    def check_cached(cache):
+        assert cache.get_total_image_count() == 2
+        assert cache.id_exists(photo_id)
+
+    run_cache(check_cached)
+    shutil.move(image_dir / "photo.png", tmp_path / "photo.png")
+
+    def check_deleted(cache):
+        assert cache.get_total_image_count() == 1
+        assert not cache.id_exists(photo_id)
+
+    run_cache(check_deleted)
+    # adding the same image again mustn't collide with metadata left behind
+    shutil.move(tmp_path / "photo.png", image_dir / "photo.png")
+
+    run_cache(check_cached)
+    # and the cache of the restart after that has to see it as well
+    run_cache(check_cached)
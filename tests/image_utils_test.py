@@ -1,58 +1,193 @@
+import base64
+import os
 import pytest
+from hypothesis import example, given, strategies as st
+from PIL import ExifTags, Image
 from api.utils.image import ImageProcessor
 
-testdata = [
+calc = ImageProcessor.calculate_scaled_size
+
+testdata = (
     # original_width, original_height, new_width, new_height
     (2048, 1536, 512, 384),
     (1536, 2048, 384, 512),
     (512, 512, 256, 256),
     (10, 2, 5, 1),
     (2, 10, 1, 5),
-]
+    (1024, 1488, 512, 744),
+)
+
+# original_width, original_height, calculate_scaled_size kwargs, expected (width, height)
+SCALE_CASES = tuple(
+    pytest.param(
+        ow, oh, kwargs, (nw, nh), id=f"{ow}x{oh}->{nw}x{nh}-{'+'.join(kwargs)}"
+    )
+    for ow, oh, nw, nh in testdata
+    for kwargs in ({"width": nw}, {"height": nh}, {"width": nw, "height": nh})
+)
 
 
 @pytest.mark.parametrize(
-    "original_width, original_height, new_width, new_height", testdata
+    "original_width, original_height, kwargs, expected", SCALE_CASES
 )
-def test_image_dimensions_should_be_scaled_correctly_with_width(
-    original_width, original_height, new_width, new_height
+def test_image_dimensions_should_be_scaled_correctly(
+    original_width, original_height, kwargs, expected
 ):
-    expected_height = new_height
+    assert calc(original_width, original_height, **kwargs) == expected
 
-    width, height = ImageProcessor.calculate_scaled_size(
-        original_width=original_width, original_height=original_height, width=new_width
-    )
-    assert width == new_width
-    assert height == expected_height
 
+@pytest.fixture
+def pinned_cpu():
+    # keep the benchmark on one core so scheduler migrations don't add noise
+    if not hasattr(os, "sched_setaffinity"):
+        yield
+        return
+
+    affinity = os.sched_getaffinity(0)
+    os.sched_setaffinity(0, {min(affinity)})
+    try:
+        yield
+    finally:
+        os.sched_setaffinity(0, affinity)
 
+
+@pytest.mark.benchmark(min_rounds=10000, disable_gc=True, warmup=True)
 @pytest.mark.parametrize(
-    "original_width, original_height, new_width, new_height", testdata
+    "original_width, original_height, kwargs, expected",
+    [
+        # scaling by width and by height, plus a case that has to round down
+        pytest.param(2048, 1536, {"width": 512}, (512, 384), id="width"),
+        pytest.param(1536, 2048, {"height": 512}, (384, 512), id="height"),
+        pytest.param(1024, 1488, {"width": 511}, (511, 742), id="round-down"),
+    ],
 )
-def test_image_dimensions_should_be_scaled_correctly_with_height(
-    original_width, original_height, new_width, new_height
+def test_calculate_scaled_size_benchmark(
+    benchmark, pinned_cpu, original_width, original_height, kwargs, expected
 ):
-    expected_width = new_width
+    assert benchmark(calc, original_width, original_height, **kwargs) == expected
 
-    width, height = ImageProcessor.calculate_scaled_size(
-        original_width=original_width,
-        original_height=original_height,
-        height=new_height,
-    )
-    assert width == expected_width
-    assert height == new_height
+
+def test_image_dimensions_should_be_kept_when_passing_width_and_height():
+    assert calc(2048, 1536, width=100, height=100) == (100, 100)
 
 
 @pytest.mark.parametrize(
-    "original_width, original_height, new_width, new_height", testdata
+    "original_width, original_height, new_width, new_height",
+    [
+        # the original is more than twice as wide as the new width
+        (10001, 3, 5000, 1),
+        (4000, 3, 1, 0),
+    ],
 )
-def test_image_dimensions_should_be_scaled_correctly_with_all_params(
+def test_image_height_should_be_rounded_down_when_scaling_by_width(
     original_width, original_height, new_width, new_height
 ):
-    width, height = ImageProcessor.calculate_scaled_size(
-        original_width=original_width,
-        original_height=original_height,
-        height=new_height,
-    )
+    width, height = calc(original_width, original_height, width=new_width)
     assert width == new_width
     assert height == new_height
+
+
+dimensions = st.integers(min_value=1, max_value=2**20)
+
+
+@given(original_width=dimensions, original_height=dimensions, new_width=dimensions)
+@example(original_width=1024, original_height=1488, new_width=512)
+@example(original_width=10001, original_height=3, new_width=5000)
+def test_scaling_by_width_should_round_height_down(
+    original_width, original_height, new_width
+):
+    width, height = calc(original_width, original_height, width=new_width)
+    assert width == new_width
+    # height is the largest integer that doesn't exceed the exact scaled height
+    assert height * original_width <= new_width * original_height
+    assert new_width * original_height < (height + 1) * original_width
+
+
+@given(original_width=dimensions, original_height=dimensions, new_height=dimensions)
+@example(original_width=1488, original_height=1024, new_height=512)
+def test_scaling_by_height_should_round_width_down(
+    original_width, original_height, new_height
+):
+    width, height = calc(original_width, original_height, height=new_height)
+    assert height == new_height
+    # width is the largest integer that doesn't exceed the exact scaled width
+    assert width * original_height <= new_height * original_width
+    assert new_height * original_width < (width + 1) * original_height
+
+
+def test_image_id_should_only_depend_on_dimensions_and_pixel_data():
+    image = Image.new("RGB", (64, 48), color="red")
+    same_image = Image.new("RGB", (64, 48), color="red")
+    other_image = Image.new("RGB", (64, 48), color="blue")
+    other_size_image = Image.new("RGB", (48, 64), color="red")
+
+    image_id = ImageProcessor.get_id(data=image)
+
+    assert image_id == ImageProcessor.get_id(data=same_image)
+    assert image_id != ImageProcessor.get_id(data=other_image)
+    assert image_id != ImageProcessor.get_id(data=other_size_image)
+
+
+# image IDs are persisted in the cache database, so streaming the pixel data has to
+# hash exactly the same bytes as tobytes() did
+@pytest.mark.parametrize("mode", ["RGB", "RGBA", "L", "1", "P", "I;16", "CMYK"])
+def test_streamed_pixel_data_should_match_tobytes(mode):
+    # 131 rows isn't a multiple of rows_per_chunk, so the last chunk is a partial one
+    noise = Image.effect_noise((97, 131), 64)
+    image = noise.convert("I").convert(mode) if mode == "I;16" else noise.convert(mode)
+
+    streamed = b"".join(ImageProcessor._iter_raw_pixel_data(image, rows_per_chunk=64))
+    assert streamed == image.tobytes()
+
+    hasher = ImageProcessor._get_id_hasher(image)
+    hasher.update(image.tobytes())
+    expected_id = (
+        base64.urlsafe_b64encode(hasher.digest(length=32)).decode("ascii").rstrip("=")
+    )
+    assert ImageProcessor.get_id(data=image) == expected_id
+
+
+@pytest.mark.parametrize(
+    "source_size, orientation, decoded_size, converted_size",
+    [
+        ((5000, 4000), 1, (2500, 2000), (2048, 1638)),
+        ((9000, 3000), 1, (2250, 750), (2048, 682)),
+        # rotated by 90 degrees, halving the stored height would end up below 2048 pixels
+        ((6000, 4000), 6, (6000, 4000), (2048, 3072)),
+    ],
+)
+def test_large_jpeg_should_be_drafted_and_converted_to_max_size(
+    tmp_path, source_size, orientation, decoded_size, converted_size
+):
+    source = tmp_path / "source.jpg"
+    exif = Image.Exif()
+    exif[ExifTags.Base.Orientation] = orientation
+    Image.new("RGB", source_size, color="red").save(source, exif=exif)
+
+    with Image.open(source) as image:
+        _, metadata = ImageProcessor.convert_to_unified_format_and_write_to_filesystem(
+            output_path=str(tmp_path), image=image
+        )
+        # the JPEG decoder already scaled the image down while decoding it
+        assert image.size == decoded_size
+
+    assert (metadata.original_width, metadata.original_height) == converted_size
+    assert metadata.media_type == "image/jpeg"
+
+
+@pytest.mark.parametrize(
+    "original_size, new_size, expected_filter",
+    [
+        ((2048, 1536), (2048, 1536), Image.Resampling.LANCZOS),
+        ((2048, 1536), (1024, 768), Image.Resampling.BILINEAR),
+        ((2048, 1536), (512, 384), Image.Resampling.BOX),
+        ((2048, 1536), (16, 12), Image.Resampling.BOX),
+        ((512, 512), (2048, 2048), Image.Resampling.LANCZOS),
+    ],
+)
+def test_resampling_filter_should_get_cheaper_with_downscaling_ratio(
+    original_size, new_size, expected_filter
+):
+    assert (
+        ImageProcessor.get_resampling_filter(original_size, new_size) == expected_filter
+    )
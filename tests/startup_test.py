@@ -91,3 +91,12 @@ class TestAppStartup:
             response = client.get("/gallery")
             assert response.status_code == 200
             assert "text/html" in response.headers["content-type"]
+
+    def test_gallery_should_not_have_an_empty_last_page(self, app):
+        # one image with a page size of one is an exact multiple of the page size
+        with TestClient(app) as client:
+            assert _wait_for_cache()
+            response = client.get("/gallery", params={"page": 1, "page_size": 1})
+            assert response.status_code == 200
+            response = client.get("/gallery", params={"page": 2, "page_size": 1})
+            assert response.status_code == 400